@@ -5,13 +5,20 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
+import errno
 import os
 import requests
 import subprocess
 
+try:
+    import orjson as json_lib # faster, when available
+except ImportError:
+    import json as json_lib
+
 __version__ = "1.0.0"
 
 ACCESS_TOKEN_FILE = "~/.gh_token"
+_TOKEN_CACHE = None # loaded access token
 
 BASE_BRANCH = "master"
 REPO_OWNER = "rynmlng" # TODO allow this to be user-inputted
@@ -38,7 +45,7 @@ def prompt(message, options=None, allow_empty=False):
         query = "{} > ".format(message)
 
     while not ret:
-        ret = raw_input(query)
+        ret = input(query)
         if allow_empty and not ret:
             break
 
@@ -46,31 +53,44 @@ def prompt(message, options=None, allow_empty=False):
 
 
 def load_token():
-    """ Load the access token from the access token file
-    
+    """ Load the access token from the access token file, caching it for this process
+
     :returns: GitHub API access token
     :rtype str:
     """
+    global _TOKEN_CACHE
+    if _TOKEN_CACHE is not None:
+        return _TOKEN_CACHE
+
     token_file_path = os.path.expanduser(ACCESS_TOKEN_FILE)
 
     access_token = None
     write_to_file = False
-    if os.path.exists(token_file_path):
-        with open(token_file_path, "rb") as token_file:
-            access_token = token_file.read().strip()
-
-        if not access_token and prompt("Token file is malformed, overwrite?", options=["y","N"]) == "N":
-            write_to_file = True
-    else:
+    try:
+        fd = os.open(token_file_path, os.O_RDONLY)
+    except OSError as e:
+        if e.errno != errno.ENOENT: # e.g. unreadable, writing to it would fail too
+            raise
         write_to_file = True
+    else:
+        try:
+            access_token = os.read(fd, 4096).strip().decode("utf-8")
+        except UnicodeDecodeError: # handled as malformed below
+            pass
+        finally:
+            os.close(fd)
+
+        if not access_token and prompt("Token file is malformed, overwrite?", options=["y","N"]) == "y":
+            write_to_file = True
 
     if not access_token:
         access_token = prompt("Enter your GitHub API token (https://github.com/settings/tokens, scope=repo)")
 
     if write_to_file:
-        with open(token_file_path, "wb") as token_file:
+        with open(token_file_path, "w") as token_file:
             token_file.write(access_token)
 
+    _TOKEN_CACHE = access_token
     return access_token
 
 
@@ -82,7 +102,9 @@ def create_pull_request(access_token):
     """
     headers = {"Authorization": "token {}".format(access_token)}
 
-    repo_path = subprocess.check_output(["git", "rev-parse", "--show-toplevel"]).strip()
+    # one git process for both the repo's path and the PR branch
+    repo_path, pr_branch = subprocess.check_output(["git", "rev-parse", "--show-toplevel", "--abbrev-ref", "HEAD"],
+                                                   text=True).splitlines()
     repo = os.path.basename(repo_path)
 
     url = "https://api.github.com/repos/{owner}/{repo}/pulls".format(owner=REPO_OWNER, repo=repo)
@@ -92,7 +114,8 @@ def create_pull_request(access_token):
     ########
     # TITLE
     ########
-    default_title = subprocess.check_output(["git","log","-1","--pretty=%B"]).strip()
+    default_title = subprocess.check_output(["git","log","-1","--pretty=%B"], text=True).strip()
+    title = None
     if default_title:
         title = prompt("Enter a title (default={})".format(default_title), allow_empty=True)
 
@@ -101,7 +124,6 @@ def create_pull_request(access_token):
     ########
     # HEAD
     ########
-    pr_branch = subprocess.check_output(["git", "rev-parse", "--abbrev-ref", "HEAD"]).strip()
     if pr_branch == BASE_BRANCH:
         raise ValueError("Your PR branch cannot be the base branch ({})!".format(BASE_BRANCH))
 
@@ -119,7 +141,8 @@ def create_pull_request(access_token):
     if body:
         params["body"] = body
 
-    res = requests.post(url, headers=headers, json=params).json()
+    headers["Content-Type"] = "application/json"
+    res = json_lib.loads(requests.post(url, headers=headers, data=json_lib.dumps(params)).content)
     if "errors" in res:
         for error in res["errors"]:
             print("\nERROR! {}\n".format(error))
@@ -139,7 +162,7 @@ def main():
     try:
         with open(os.devnull, "w") as FNULL:
             is_work_tree = subprocess.check_output(["git", "rev-parse", "--is-inside-work-tree"],
-                                                   stderr=FNULL).strip()
+                                                   stderr=FNULL, text=True).strip()
     except subprocess.CalledProcessError:
         is_work_tree = "false"
 
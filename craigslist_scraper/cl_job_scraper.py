@@ -1,22 +1,161 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 __version__ = "1.0.0"
 
 from abc import ABCMeta
 from cl_scraper import *
-from lxml import html
-from utils import prompt, retry
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from lxml import etree, html
+from requests.adapters import HTTPAdapter
+from utils import THROTTLED_STATUS_CODES, get_retry_wait, prompt, retry
 
+import aiohttp
 import argparse
+import asyncio
 import csv
 import functools
+import io
 import logging
 import requests
 import os
+import sys
+import threading
 import time
 
 
+MAX_CONCURRENT_REQUESTS = 8 # job pages in flight at once, keep it polite
+MAX_DOMAIN_WORKERS = 8 # domains scraped in parallel, each still paced by SLEEP_TIME
+RETRY_BASE = 1.0 # seconds, doubled on every failed attempt
+MAX_BODY_SIZE = 5000000 # bytes, anything bigger isn't a job page
+
+# one session per thread, requests doesn't promise a Session is thread-safe
+_thread_local = threading.local()
+
+# set on Ctrl-C, so in-flight domain scrapes stop after their current page
+_stop_scraping = threading.Event()
+
+# compiled once at import, rather than re-parsed on every page
+_DOMAIN_XPATH = etree.XPath(".//div[contains(@class, 'box')]//a")
+_CONTENT_ANCESTOR_XPATH = etree.XPath("ancestor::div[contains(@class, 'content')]")
+_MAP_TAG_XPATH = etree.XPath(".//span[@class='maptag']")
+_JOB_LINK_XPATH = etree.XPath(".//a[@class='hdrlnk']")
+
+
+def get_session():
+    """ Get this thread's session, so every page reuses a keep-alive connection instead of a new handshake.
+
+    :returns: Session of the calling thread
+    :rtype: requests.Session
+    """
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(max_retries=0))
+        session.mount("https://", HTTPAdapter(max_retries=0))
+        _thread_local.session = session
+
+    return session
+
+
+async def _fetch(session, url, max_retries=5):
+    """ GET the url's body, retrying with backoff until it returns or we hit the max retry count.
+
+    :param session: Session to send the request with
+    :type session: aiohttp.ClientSession
+
+    :param url: URL to request
+    :type url: str
+
+    :param max_retries: Maximum amount of retries for the request
+    :type max_retries: int
+
+    :returns: Response body, or None when it isn't an HTML page worth parsing
+    :rtype: bytes
+    """
+    for i in range(max_retries):
+        retry_after = None
+        try:
+            async with session.get(url) as res:
+                if res.status not in THROTTLED_STATUS_CODES or i == max_retries - 1:
+                    if res.status >= 500:
+                        res.raise_for_status()
+
+                    # don't waste a parse on error stubs, redirects, images, etc.
+                    if res.status != 200 or res.content_type != "text/html" or \
+                            (res.content_length or 0) > MAX_BODY_SIZE:
+                        logger.debug("Skipping %s response (%s) from %s", res.status, res.content_type, url)
+                        return None
+
+                    body = await res.read()
+                    return body if len(body) <= MAX_BODY_SIZE else None
+
+                retry_after = res.headers.get("Retry-After")
+        except aiohttp.ClientError:
+            if i == max_retries - 1:
+                raise
+
+        await asyncio.sleep(get_retry_wait(i, RETRY_BASE, retry_after))
+
+
+def _iterparse_html(source, tag):
+    """ Stream-parse an HTML document, yielding elements as soon as they're complete.
+          Each element is freed once the caller is done with it, so the whole DOM is never held.
+
+    :param source: File-like object of the HTML document
+    :type source: file
+
+    :param tag: Tag(s) of the elements to yield
+    :type tag: str or tuple<str>
+
+    :returns: Generator yielding complete elements, including their children
+    :rtype: generator<lxml.etree._Element>
+    """
+    for event, elem in etree.iterparse(source, events=("end",), tag=tag, html=True):
+        yield elem
+
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def _parse_job(body):
+    """ Parse a job's page for its details. Kept at module-level so it can run in a worker process.
+
+    :param body: HTML document of the job's page
+    :type body: bytes
+
+    :returns: Job details including title, company, latitude, and longitude
+    :rtype: tuple
+    """
+    title = company = latitude = longitude = None
+
+    # parse results, stopping as soon as we have what we need
+    is_title_found = is_map_found = False
+    for elem in _iterparse_html(io.BytesIO(body), ("span", "div")):
+        elem_id = elem.get("id")
+        if elem_id == "titletextonly":
+            title = elem.text
+            is_title_found = True
+        elif elem_id == "map":
+            latitude = elem.get("data-latitude")
+            longitude = elem.get("data-longitude")
+            is_map_found = True
+
+        if is_title_found and is_map_found:
+            break
+
+    if not is_title_found:
+        raise MissingDataException("Title is missing from job listing")
+
+    company = "A Company That's Hiring" # XXX no reliable way to parse this from CL
+
+    if not is_map_found:
+        raise MissingDataException("Map coordinates are missing from job listing")
+
+    return title, company, latitude, longitude
+
+
 class CLJobScraper(CLScraper):
     """ Scrapes Craiglist for job listings and outputs them into CSVs. """
     __metaclass__ = ABCMeta
@@ -28,23 +167,32 @@ class CLJobScraper(CLScraper):
     def scrape_types(self):
         return ("scrape_domains", "scrape_all_jobs", "scrape_job_details")
 
-    @csv_out(root_filename=DOMAINS_ROOT_FILENAME, header=("City", "Domain"))
     def scrape_domains(self):
+        """ Scrape for all Craigslist domains and output into CSV files, unless they're still fresh. """
+        # checked before any output is opened, so there's no "already exists" prompt for a no-op
+        domains_files = get_matching_csv_files(CLJobScraper.DOMAINS_ROOT_FILENAME)
+        if domains_files and time.time() - max(os.path.getmtime(f) for f in domains_files) < DOMAINS_TTL:
+            logger.info("Domains were scraped within the last %ss, reusing them", DOMAINS_TTL)
+            return
+
+        self._scrape_domains()
+
+    @csv_out(root_filename=DOMAINS_ROOT_FILENAME, header=("City", "Domain"))
+    def _scrape_domains(self):
         """ Scrape for all Craigslist domains and output into CSV files.
 
         :returns: Generator yielding Craiglist cities & links to their listings
         :rtype: generator<str, str>
         """
         DOMAINS_ENDPOINT = "http://www.craigslist.org/about/sites"
-        DOMAIN_XPATH = ".//div[contains(@class, 'box')]//a"
 
         logger.debug("Scraping domains, hitting endpoint %s", DOMAINS_ENDPOINT)
 
-        res = retry(functools.partial(requests.get, DOMAINS_ENDPOINT), SLEEP_TIME)
+        res = retry(get_session().get, DOMAINS_ENDPOINT)
 
         doc = html.fromstring(res.text)
 
-        for anchor_elem in doc.xpath(DOMAIN_XPATH):
+        for anchor_elem in _DOMAIN_XPATH(doc):
             href = "http:{}".format(anchor_elem.get("href"))
             city = anchor_elem.text
 
@@ -52,7 +200,8 @@ class CLJobScraper(CLScraper):
 
     @csv_out(root_filename="job_details", header=("Title", "Company", "Latitude", "Longitude"))
     def scrape_job_details(self):
-        """ Scrape all job details iteratively from what we already have.
+        """ Scrape all job details concurrently from what we already have.
+              Rows are handed over through a queue, so the CSV writer stays single-threaded.
 
         :returns: Generator yielding Craiglist job details
         :rtype: generator<str, str, str, str>
@@ -62,58 +211,94 @@ class CLJobScraper(CLScraper):
         job_detail_files = get_matching_csv_files(CLJobScraper.JOB_LINKS_ROOT_FILENAME)
         if not job_detail_files:
             logger.debug("No files found with root filename %s", CLJobScraper.JOB_LINKS_ROOT_FILENAME)
-        else:
-            for filename in job_detail_files:
-                with open(filename, "rb") as csv_file:
-                    csv_reader = csv.reader(csv_file)
-                    header = csv_reader.next()
+            return
 
-                    for row in csv_reader:
-                        res = scrape_single_job_details(row[0])
-                        if res is not None:
-                            yield res,
+        # gather every listing URL upfront, so all jobs can be scheduled at once
+        endpoints = []
+        for filename in job_detail_files:
+            with open(filename, "r", newline="") as csv_file:
+                csv_reader = csv.reader(csv_file)
+                next(csv_reader) # skip the header
 
-                        logger.debug("Sleeping Zzz")
-                        time.sleep(SLEEP_TIME) # sleep to avoid being blacklisted
+                endpoints.extend([row[0] for row in csv_reader])
 
-    def scrape_single_job_details(self, endpoint):
-        """ Scrapes a single job's page for details.
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
 
-        :param endpoint: The endpoint where to get job details from
-        :type endpoint: str
+        queue = asyncio.Queue()
+        producer = loop.create_task(self.scrape_all_job_details(endpoints, queue))
 
-        :returns: Job details including title, company, latitude, and longitude
-        :rtype: tuple
+        try:
+            while True:
+                # run the event loop only until the next row is ready to be written
+                row = loop.run_until_complete(queue.get())
+                if row is None: # all jobs have been scraped
+                    break
+
+                yield row
+
+            loop.run_until_complete(producer) # surface any errors from the producer
+        finally:
+            if not producer.done():
+                producer.cancel()
+                loop.run_until_complete(asyncio.gather(producer, return_exceptions=True))
+
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    async def scrape_all_job_details(self, endpoints, queue):
+        """ Scrape the details of every job, bounding how many are in flight.
+
+        :param endpoints: Endpoints where to get job details from
+        :type endpoints: list
+
+        :param queue: Queue to put job details on, terminated by None
+        :type queue: asyncio.Queue
         """
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        connector = aiohttp.TCPConnector(limit_per_host=MAX_CONCURRENT_REQUESTS)
 
-        TITLE_XPATH = ".//span[@id='titletextonly']"
-        MAP_XPATH = ".//div[@id='map']"
+        async def scrape(session, parse_pool, endpoint):
+            async with semaphore:
+                res = await self.scrape_single_job_details(session, endpoint, parse_pool)
 
-        title = company = latitude = longitude = None
+                logger.debug("Sleeping Zzz")
+                await asyncio.sleep(SLEEP_TIME) # sleep to avoid being blacklisted
+
+            if res is not None:
+                await queue.put(res)
 
         try:
-            logger.debug("Hitting single job endpoint %s", endpoint)
-            res = retry(functools.partial(requests.get, endpoint), SLEEP_TIME)
+            with ProcessPoolExecutor(max_workers=os.cpu_count()) as parse_pool:
+                async with aiohttp.ClientSession(connector=connector) as session:
+                    await asyncio.gather(*[scrape(session, parse_pool, endpoint) for endpoint in endpoints])
+        finally:
+            await queue.put(None)
 
-            # parse results
-            doc = html.fromstring(res.text)
+    async def scrape_single_job_details(self, session, endpoint, parse_pool):
+        """ Scrapes a single job's page for details.
 
-            title_elem = doc.find(TITLE_XPATH)
-            if title_elem is not None:
-                title = title_elem.text
-            else:
-                raise MissingDataException("Title is missing from job listing")
+        :param session: Session to send the request with
+        :type session: aiohttp.ClientSession
 
-            company = "A Company That's Hiring" # XXX no reliable way to parse this from CL
+        :param endpoint: The endpoint where to get job details from
+        :type endpoint: str
+
+        :param parse_pool: Pool of worker processes to parse the job's page in
+        :type parse_pool: concurrent.futures.ProcessPoolExecutor
 
-            map_elem = doc.find(MAP_XPATH)
-            if map_elem is not None:
-                latitude = map_elem.get("data-latitude")
-                longitude = map_elem.get("data-longitude")
-            else:
-                raise MissingDataException("Map coordinates are missing from job listing")
+        :returns: Job details including title, company, latitude, and longitude
+        :rtype: tuple
+        """
+        try:
+            logger.debug("Hitting single job endpoint %s", endpoint)
+            body = await _fetch(session, endpoint)
+            if body is None:
+                return None
 
-            return title, company, latitude, longitude
+            # parse in another process, while other jobs keep downloading
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(parse_pool, _parse_job, body)
         except MissingDataException: # raises are for failing fast
             pass
         except Exception:
@@ -129,50 +314,74 @@ class CLJobScraper(CLScraper):
         :returns: Generator yielding Craiglist job links to their listings
         :rtype: generator<str>
         """
-        JOB_XPATH = (".//div[contains(@class, 'content')]"
-                      "//p[contains(@class, 'row')]")
-        MAP_TAG_XPATH = ".//span[@class='maptag']"
-        JOB_LINK_XPATH = ".//a[@class='hdrlnk']"
         MAX_RESULTS = 100
 
-        payload = {"employment_type": "1", "s": 1}
+        # resume where an interrupted scrape of this domain left off
+        offset = load_checkpoint().get(domain, 1)
+        if offset is None:
+            logger.info("Skipping %s, already scraped according to the checkpoint", domain)
+            return
+
+        payload = {"employment_type": "1", "s": offset}
 
-        endpoint = os.path.join(domain, "search", "jjj")
+        endpoint = "{}/search/jjj".format(domain.rstrip("/"))
         logger.debug("Hitting jobs endpoint %s w/payload %s", endpoint, payload)
 
-        res = retry(functools.partial(requests.get, endpoint, params=payload), SLEEP_TIME)
+        res = retry(get_session().get, endpoint, params=payload, stream=True)
+        requested_at = time.monotonic() # after any throttled retries, so pacing follows the last request
 
         while True:
+            if not res.ok:
+                # no checkpoint, so the next run retries this page rather than calling the domain done
+                logger.warning("Stopped scraping %s, got a %s response w/payload %s", domain, res.status_code, payload)
+                res.close()
+                break
+
+            listing_count = 0
+            is_page_scraped = False
             try:
-                # parse results
-                doc = html.fromstring(res.text)
+                # parse results as they stream in
+                res.raw.decode_content = True
+                for listing in _iterparse_html(res.raw, "p"):
+                    # only rows of the results list, ancestors stay intact while streaming
+                    if "row" not in listing.get("class", "") or not _CONTENT_ANCESTOR_XPATH(listing):
+                        continue
 
-                listings = doc.xpath(JOB_XPATH)
-                if not listings:
-                    logger.debug("Paginated scraping complete")
-                    break
+                    listing_count += 1
 
-                logger.debug("%s listings found", len(listings))
-                for listing in listings:
                     # this signifies we can get the lat & long when drilling
-                    if listing.find(MAP_TAG_XPATH) is not None:
-                        anchor_elem = listing.find(JOB_LINK_XPATH)
+                    if _MAP_TAG_XPATH(listing):
+                        anchor_elem = _JOB_LINK_XPATH(listing)[0]
                         link = "{}{}".format(domain, anchor_elem.get("href")[1:]) # slice off the leading slash
 
                         yield link,
+
+                logger.debug("%s listings found", listing_count)
+                is_page_scraped = True
             except Exception:
                 logger.exception("Encountered an issue while scraping jobs", exc_info=True)
             finally:
-                if len(listings) < MAX_RESULTS:
-                    logger.debug("Paginated scraping complete")
-                    break
+                res.close()
 
-                payload["s"] += MAX_RESULTS
+            # checkpoints go out with the rows, so they're only saved once this page's links are on disk
+            if listing_count < MAX_RESULTS:
+                if is_page_scraped:
+                    yield Checkpoint(domain, None) # nothing left to resume
+                logger.debug("Paginated scraping complete")
+                break
 
-                logger.debug("Sleeping Zzz")
-                time.sleep(SLEEP_TIME) # sleep to avoid being blacklisted
-                logger.debug("Hitting jobs endpoint %s w/payload %s", endpoint, payload)
-                res = retry(functools.partial(requests.get, endpoint, params=payload), SLEEP_TIME)
+            payload["s"] += MAX_RESULTS
+            yield Checkpoint(domain, payload["s"])
+
+            # sleep to avoid being blacklisted, counting the time already spent on the last page
+            logger.debug("Sleeping Zzz")
+            if _stop_scraping.wait(max(0, SLEEP_TIME - (time.monotonic() - requested_at))):
+                logger.info("Stopped scraping %s, it can be resumed from the checkpoint", domain)
+                break
+
+            logger.debug("Hitting jobs endpoint %s w/payload %s", endpoint, payload)
+            res = retry(get_session().get, endpoint, params=payload, stream=True)
+            requested_at = time.monotonic()
 
     def scrape_all_jobs(self):
         """ Scrape for all Craigslist jobs and output into CSV files.
@@ -186,35 +395,47 @@ class CLJobScraper(CLScraper):
 
         all_domains = []
         for filename in jobs_files:
-            with open(filename, "rb") as csv_file:
+            with open(filename, "r", newline="") as csv_file:
                 csv_reader = csv.reader(csv_file)
-                header = csv_reader.next()
+                next(csv_reader) # skip the header
 
-                for row in csv_reader:
-                    city, domain = row
-                    all_domains.append(domain)
+                all_domains.extend([domain for city, domain in csv_reader])
 
         if self.is_interactive:
             res = prompt("Scrape all domains?", ("y","N"))
             if res == "N":
-                print_str = ""
-                for i, domain in enumerate(all_domains, start=1):
-                    print_str += "{:<3}. {:<50}".format(i, domain)
-
-                    # 2 domains per line
-                    if not(i % 2):
-                        print(print_str)
-                        print_str = ""
-
-                print("")
+                # 2 domains per line, written all at once
+                lines = ["{:<3}. {:<50}{}".format(i, domain, "" if i % 2 else "\n")
+                         for i, domain in enumerate(all_domains, start=1)]
+                sys.stdout.write("".join(lines).rstrip("\n") + "\n\n")
                 res = prompt("What domain do you want to scrape?")
                 try:
                     all_domains = [all_domains[int(res)-1]]
                 except (IndexError, ValueError):
                     raise ValueError("Invalid number provided")
 
-        for domain in all_domains:
-            self.scrape_jobs(domain)
+        # ask before repeating the scrape here, worker threads can't share stdin for prompts
+        try:
+            confirm_csv_overwrite(CLJobScraper.JOB_LINKS_ROOT_FILENAME, self.is_interactive)
+        except IntensiveOpException: # nothing will happen, fail gracefully
+            logger.info("Skipping an intensive operation")
+            return
+
+        # politeness is per domain, so different domains can be scraped side by side
+        executor = ThreadPoolExecutor(max_workers=MAX_DOMAIN_WORKERS)
+        try:
+            list(executor.map(functools.partial(self.scrape_jobs, is_interactive=False), all_domains))
+        except KeyboardInterrupt:
+            # don't wait on every queued domain, in-flight ones stop after their current page
+            _stop_scraping.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        executor.shutdown()
+
+        # domains that made it through start fresh next run, the rest resume where they failed
+        checkpoint = load_checkpoint()
+        clear_checkpoint([domain for domain in all_domains if domain in checkpoint and checkpoint[domain] is None])
 
 
 def main():
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
 __version__ = "1.0.0"
@@ -7,8 +7,11 @@ from abc import ABCMeta, abstractproperty
 from utils import prompt
 
 import csv
+import json
 import logging
 import os
+import queue
+import threading
 
 
 LOGGING_FORMAT = "%(asctime)s %(levelname)s: %(message)s"
@@ -19,8 +22,16 @@ logger.setLevel(logging.INFO) # default
 
 # TODO make filepath absolute for future usage
 CSV_DIR = os.path.join(os.getcwd(), "csv")
+_CSV_PREFIX = CSV_DIR + os.sep # precomputed for building CSV paths
 MAX_CSV_ROWS = 1000 # TODO find the sweet number (i.e. fast I/O, not too much in memory)
 SLEEP_TIME = 30
+CHECKPOINT_FILE = os.path.join(CSV_DIR, ".checkpoint.json") # progress of interrupted scrapes
+DOMAINS_TTL = 24 * 60 * 60 # seconds before scraped domains are considered stale
+
+# filenames handed out but maybe not written yet, so concurrent scrapes never share a CSV
+_reserved_csv_filenames = set()
+_csv_filename_lock = threading.Lock()
+_checkpoint_lock = threading.Lock()
 
 class IntensiveOpException(Exception):
     """ Exception raised when we don't want to repeat an already intensive operation. """
@@ -32,6 +43,77 @@ class MissingDataException(Exception):
     pass
 
 
+class Checkpoint(object):
+    """ Progress yielded among a csv_out method's rows, saved only once every row before it is on disk. """
+    __slots__ = ("key", "value")
+
+    def __init__(self, key, value):
+        """ Initialize our checkpoint.
+
+        :param key: What is being scraped
+        :type key: str
+
+        :param value: Progress of the scrape
+        :type value: Anything JSON-serializable
+        """
+        self.key = key
+        self.value = value
+
+
+def load_checkpoint():
+    """ Load the progress saved by earlier, possibly interrupted, scrapes.
+
+    :returns: Progress keyed by what was being scraped
+    :rtype: dict
+    """
+    try:
+        with open(CHECKPOINT_FILE, "r") as checkpoint_file:
+            return json.load(checkpoint_file)
+    except (OSError, ValueError): # missing or half-written, start over
+        return {}
+
+
+def _write_checkpoint(checkpoint):
+    """ Write the checkpoint then swap it in, so a crash never leaves a torn file behind.
+
+    :param checkpoint: Progress keyed by what was being scraped
+    :type checkpoint: dict
+    """
+    tmp_filename = CHECKPOINT_FILE + ".tmp"
+    with open(tmp_filename, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(tmp_filename, CHECKPOINT_FILE)
+
+
+def save_checkpoint(key, value):
+    """ Save the progress of a scrape so it can be resumed. Safe to call from many threads.
+
+    :param key: What is being scraped
+    :type key: str
+
+    :param value: Progress of the scrape
+    :type value: Anything JSON-serializable
+    """
+    with _checkpoint_lock:
+        checkpoint = load_checkpoint()
+        checkpoint[key] = value
+        _write_checkpoint(checkpoint)
+
+
+def clear_checkpoint(keys):
+    """ Forget the progress of scrapes, so they start from scratch next time.
+
+    :param keys: What was being scraped
+    :type keys: collection
+    """
+    with _checkpoint_lock:
+        checkpoint = load_checkpoint()
+        for key in keys:
+            checkpoint.pop(key, None)
+
+        _write_checkpoint(checkpoint)
+
+
 def get_matching_csv_files(root_filename):
     """ Get all CSV files that match the passed-in criteria.
 
@@ -41,16 +123,32 @@ def get_matching_csv_files(root_filename):
     :returns: List of filenames matching the criteria
     :rtype: list
     """
-    filenames = []
-    for filename in os.listdir(CSV_DIR):
-        if filename.startswith(root_filename):
-            filenames.append(os.path.join(CSV_DIR, filename))
+    return [entry.path for entry in os.scandir(CSV_DIR) if entry.name.startswith(root_filename)]
+
+
+def confirm_csv_overwrite(root_filename, is_interactive=False):
+    """ Prompt before repeating an operation whose first CSV file already exists.
+
+    :param root_filename: Filename the CSV should start with
+    :type root_filename: str
+
+    :param is_interactive: Script can expect input from end user
+    :type is_interactive: bool
 
-    return filenames
+    :raises IntensiveOpException: End user chose not to repeat the operation
+    """
+    filename = "{}.csv".format(root_filename)
+    if is_interactive and os.path.exists(_CSV_PREFIX + filename):
+        res = prompt(("{} already exists, you may be repeating an intensive operation. "
+                      "Continue?").format(filename), ("y", "N"))
+        if res == "N":
+            ex_msg = "Avoiding operations that would regenerate {}".format(filename)
+            logger.warning(ex_msg)
+            raise IntensiveOpException(ex_msg)
 
 
 def get_next_csv_filename(root_filename, last_index=0, is_interactive=False):
-    """ Get the next CSV filename we should use to avoid overwriting.
+    """ Get the next CSV filename we should use to avoid overwriting. Safe to call from many threads.
 
     :param root_filename: Filename the CSV should start with
     :type root_filename: str
@@ -64,31 +162,31 @@ def get_next_csv_filename(root_filename, last_index=0, is_interactive=False):
     :returns: CSV filename
     :rtype: str
     """
-    if last_index == 0:
-        file_index = ""
-    else:
-        file_index = last_index + 1
+    with _csv_filename_lock:
+        if last_index == 0:
+            confirm_csv_overwrite(root_filename, is_interactive)
+
+        # one directory scan, rather than a stat per candidate filename
+        existing_filenames = {entry.name for entry in os.scandir(CSV_DIR) if entry.name.startswith(root_filename)}
 
-    filename = "{}{}.csv".format(root_filename, file_index)
+        file_index = last_index
+        filename = "{}{}.csv".format(root_filename, file_index + 1 if file_index else "")
 
-    filename_path = os.path.join(CSV_DIR, filename)
-    if os.path.exists(filename_path):
-        if last_index == 0 and is_interactive:
-            # prompt before repeating an operation already done
-            res = prompt(("{} already exists, you may be repeating an intensive operation. "
-                          "Continue?").format(filename), ("y", "N"))
-            if res == "N":
-                ex_msg = "Avoiding operations that would regenerate {}".format(filename)
-                logger.warning(ex_msg)
-                raise IntensiveOpException(ex_msg)
+        existing_filenames.update(_reserved_csv_filenames)
+        while filename in existing_filenames:
+            file_index += 1
+            filename = "{}{}.csv".format(root_filename, file_index + 1)
 
-        return get_next_csv_filename(root_filename, file_index or 1, is_interactive)
-    else:
-        return filename_path
+        _reserved_csv_filenames.add(filename)
+
+    return _CSV_PREFIX + filename
 
 
 def csv_out(root_filename, header, rows_per_file=MAX_CSV_ROWS):
     """ CSV file-writer and context manager for writing many CSV files.
+          The decorated method takes an extra is_interactive keyword-arg, overriding
+          the scraper's for callers that can't prompt, e.g. worker threads.
+          It may yield Checkpoints among its rows, which are saved after the rows before them.
 
     :param root_filename: Filename the CSV should start with
     :type root_filename: str
@@ -104,6 +202,8 @@ def csv_out(root_filename, header, rows_per_file=MAX_CSV_ROWS):
     """
     def csv_out_decorator(method):
         def wrapper(self, *args, **kwargs):
+            is_interactive = kwargs.pop("is_interactive", self.is_interactive)
+
             def save_rows(rows, filename):
                 """ Save the provided rows to the CSV file.
 
@@ -115,55 +215,88 @@ def csv_out(root_filename, header, rows_per_file=MAX_CSV_ROWS):
                 """
                 logger.info("Saving %s", filename)
 
-                row_save_count = 0
-                with open(filename, "wb") as csv_file:
+                with open(filename, "w", newline="") as csv_file:
                     csv_writer = csv.writer(csv_file)
                     csv_writer.writerow(header)
-                    for row in rows:
-                        if row is None:
-                            break
+                    csv_writer.writerows(rows)
+
+                logger.debug("Successfully saved %s rows", len(rows))
+
+            def write_batches():
+                """ Save batches of rows off the queue until the None sentinel, so disk I/O
+                      overlaps with scraping, then the checkpoints reached by those rows.
+                      Errors are kept to be re-raised by the scraping thread.
+                """
+                while True:
+                    batch = batches.get()
+                    if batch is None:
+                        break
+
+                    if write_errors: # keep draining, but never checkpoint past lost rows
+                        continue
 
-                        csv_writer.writerow(row)
-                        row_save_count += 1
+                    batch_rows, batch_filename, batch_checkpoints = batch
+                    try:
+                        if batch_rows:
+                            save_rows(batch_rows, batch_filename)
 
-                logger.debug("Successfully saved %s rows", row_save_count)
+                        # only the latest progress of each scrape matters
+                        for key, value in {c.key: c.value for c in batch_checkpoints}.items():
+                            save_checkpoint(key, value)
+                    except Exception as e:
+                        write_errors.append(e)
+
+            batches = queue.Queue(maxsize=2) # bounded, so unwritten rows can't pile up in memory
+            write_errors = []
+
+            writer = threading.Thread(target=write_batches, daemon=True)
+            writer.start()
 
             filename = None
             file_index = 0
 
-            rows_counter = 0 # how many rows will be written, also a signal whether or not to write rows
-            empty_rows = [None for i in xrange(rows_per_file)] # init to this size
-            rows = empty_rows[:]
+            rows = [] # rows to be written, also a signal whether or not to write rows
+            checkpoints = [] # reached by the rows to be written
 
             try:
-                filename = get_next_csv_filename(root_filename, file_index, self.is_interactive)
+                filename = get_next_csv_filename(root_filename, file_index, is_interactive)
                 file_index += 1
 
                 logger.debug("Building CSV rows...")
 
                 for row in method(self, *args, **kwargs):
-                    rows[rows_counter] = row
-                    rows_counter += 1
+                    if isinstance(row, Checkpoint):
+                        checkpoints.append(row)
+                        continue
+
+                    rows.append(row)
 
-                    if rows_counter % rows_per_file == 0:
-                        save_rows(rows, filename)
+                    if len(rows) >= rows_per_file:
+                        batches.put((rows, filename, checkpoints))
 
                         # prep for next file
-                        filename = get_next_csv_filename(root_filename, file_index, self.is_interactive)
+                        filename = get_next_csv_filename(root_filename, file_index, is_interactive)
                         file_index += 1
 
                         # reset
-                        rows = empty_rows[:]
-                        rows_counter = 0
+                        rows = []
+                        checkpoints = []
 
                 logger.debug("Done building CSV rows")
             except IntensiveOpException: # nothing will happen, fail gracefully
                 logger.info("Skipping an intensive operation")
-                rows_counter = 0
+                rows = []
+                checkpoints = []
             finally:
                 # save any intermediary results, then exception is raised
-                if rows_counter:
-                    save_rows(rows, filename)
+                if rows or checkpoints:
+                    batches.put((rows, filename, checkpoints))
+
+                batches.put(None)
+                writer.join()
+
+                if write_errors:
+                    raise write_errors[0]
 
         return wrapper
     return csv_out_decorator
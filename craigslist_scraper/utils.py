@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
 
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+
+import random
 import time
 
 
+THROTTLED_STATUS_CODES = (429, 503)
+MAX_RETRY_WAIT = 300 # seconds, a server's Retry-After can't stall us for longer
+
+
 def prompt(message, options=None):
     """ Prompt user in interactive shell for an answer, optionally limiting input
 
@@ -15,37 +23,85 @@ def prompt(message, options=None):
     :returns: Answer from user
     :rtype: str
     """
-    ret = ""
-
     if options:
         query = "{} ({}) > ".format(message, ",".join(options))
+        options = frozenset(options)
     else:
         query = "{} > ".format(message)
 
-    while not ret or (options and ret not in options):
-        ret = raw_input(query)
+    while True:
+        ret = input(query) # raises EOFError once stdin is closed, rather than spinning
+        if ret and (not options or ret in options):
+            return ret
+
 
-    return ret
+def get_retry_wait(attempt, base, retry_after=None):
+    """ Get how long to wait before the next attempt, preferring the server's Retry-After.
 
+    :param attempt: Zero-based attempt that just failed
+    :type attempt: int
 
-def retry(partial, sleep, max_retries=5):
-    """ Calls a partial function until it returns or we hit the max retry count.
+    :param base: Base of the exponential backoff, in seconds
+    :type base: float
+
+    :param retry_after: Value of the response's Retry-After header, in seconds or as an HTTP-date
+    :type retry_after: str
+
+    :returns: Seconds to wait
+    :rtype: float
+    """
+    if retry_after:
+        try:
+            return min(max(0.0, float(retry_after)), MAX_RETRY_WAIT)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+            except (TypeError, ValueError):
+                pass
+            else:
+                # HTTP-dates are in GMT, but a "-0000" offset parses as a naive datetime
+                if retry_at.tzinfo is None:
+                    retry_at = retry_at.replace(tzinfo=timezone.utc)
+                return min(max(0.0, retry_at.timestamp() - time.time()), MAX_RETRY_WAIT)
 
-    :param partial: Partial function
-    :type partial: functools.partial
+    return base * 2 ** attempt + random.uniform(0, 0.5)
+
+
+def retry(fn, *args, base=1.0, max_retries=5, **kwargs):
+    """ Calls a function until it returns a response the server didn't throttle,
+          or we hit the max retry count. Waits back off exponentially unless the server
+          tells us how long to wait through Retry-After.
+
+    :param fn: Function returning a requests response
+    :type fn: callable
+
+    :param args: Args to call the function with
+    :type args: list
+
+    :param base: Base of the exponential backoff between retries, in seconds
+    :type base: float
 
     :param max_retries: Maximum amount of retries for the function's return value
     :type max_retries: int
 
+    :param kwargs: Keyword-args to call the function with
+    :type kwargs: dict
+
     :returns: Function's return value
-    :rtype: Anything
+    :rtype: requests.Response
     """
-    i = 0
-    while i < max_retries:
-        i += 1
+    for i in range(max_retries):
         try:
-            return partial()
+            res = fn(*args, **kwargs)
         except Exception:
-            if i == max_retries:
+            if i == max_retries - 1:
                 raise
-            time.sleep(sleep)
+            time.sleep(get_retry_wait(i, base))
+            continue
+
+        if res.status_code not in THROTTLED_STATUS_CODES or i == max_retries - 1:
+            return res
+
+        retry_after = res.headers.get("Retry-After")
+        res.close() # hand the throttled response's connection back to the pool before waiting
+        time.sleep(get_retry_wait(i, base, retry_after))
@@ -8,17 +8,25 @@
 """
 
 from abc import ABCMeta, abstractmethod
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-import datetime
+import errno
+import fcntl
 import gdata.gauth
 import gdata.client
 import gdata.spreadsheets.client
 import functools
-import json
 import os
 import requests
+import threading
 import time
 
+try:
+    import orjson as json_lib # faster, when available
+except ImportError:
+    import json as json_lib
+
 
 # NOTE Store this encrypted somewhere, e.g. in a Django app's settings.py file
 #      If on a secure machine you can hard-code the values here, but make sure not to share it!
@@ -34,6 +42,14 @@ def decrypt_token(token):
 
 
 TOKENS_FILE = os.path.join(os.path.dirname(__file__),"gauth_tokens.json")
+_tokens_cache = (None, {}) # ((mtime, size), parsed content) of the tokens file
+
+# urllib3 before 1.26 calls Retry's allowed_methods method_whitelist
+try:
+    Retry(allowed_methods=None)
+    _RETRY_METHODS_KWARG = 'allowed_methods'
+except TypeError:
+    _RETRY_METHODS_KWARG = 'method_whitelist'
 
 class GClient(object):
     """ This class also handles maintaining a connection
@@ -48,6 +64,15 @@ class GClient(object):
     __metaclass__ = ABCMeta
 
     REFRESH_TOKEN_URL = 'https://www.googleapis.com/oauth2/v3/token'
+    EXPIRY_BUFFER = 60 # seconds, tokens this close to expiring are refreshed anyway
+
+    # API blips are retried with exponential backoff, the last response is returned if they persist
+    RETRY = Retry(total=4, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                  raise_on_status=False, **{_RETRY_METHODS_KWARG: ['GET', 'POST', 'PUT']})
+
+    # refresh locks keyed by the Google API's NAME, shared by every client of that API
+    _refresh_locks = {}
+    _refresh_locks_lock = threading.Lock()
 
     def __init__(self):
         """ Creates an object of the type GClient"""
@@ -60,34 +85,54 @@ class GClient(object):
         self._client_secret = decrypt_token(settings['GCLIENT_SECRET'])
 
         self._access_token = None
-        self._expiry_from_epoch = None # datetime of token expiration
+        self._expiry_from_epoch = None # epoch seconds of token expiration
+
+        # reuse connections to Google across calls, rather than a new TCP+TLS handshake each time
+        self._session = requests.Session()
+        self._session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                                    max_retries=self.RETRY))
+
+        # bound once, rather than looked up on every call
+        self._methods = {'get': self._session.get,
+                         'post': self._session.post,
+                         'put': self._session.put}
 
         tokens_json = self.load_tokens_file()
         if tokens_json:
             self._load_json_tokens(tokens_json)
 
+    def __del__(self):
+        session = getattr(self, '_session', None)
+        if session is not None:
+            session.close()
+
     def load_tokens_file(self):
-        """ Returns a dict of the parsed tokens file's content """
-
-        tokens_json = {}
-        if os.path.exists(TOKENS_FILE):
-            retries = 5
-            is_read = False
-            while retries > 0:
-                try:
-                    with open(TOKENS_FILE, 'r') as tokens_file:
-                        tokens_json = json.load(tokens_file)
-
-                    is_read = True
-                    break
-                # another process is messing with the file
-                except IOError:
-                    time.sleep(5)
-                finally:
-                    retries -= 1
-
-            if not is_read:
-                raise Exception('Tokens file (%s) could not be read. Max retries reached.' % TOKENS_FILE)
+        """ Returns a dict of the parsed tokens file's content, only re-parsing it
+              after it has been modified. The dict is shared, don't mutate it.
+        """
+
+        global _tokens_cache
+
+        try:
+            stat = os.stat(TOKENS_FILE)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+
+        # the size backs up the mtime, which may only have a resolution of seconds
+        cached_stat_key, cached_tokens_json = _tokens_cache
+        if (stat.st_mtime, stat.st_size) == cached_stat_key:
+            return cached_tokens_json
+
+        with open(TOKENS_FILE, 'rb') as tokens_file:
+            # blocks only while another process is writing the file
+            fcntl.flock(tokens_file, fcntl.LOCK_SH)
+            content = tokens_file.read()
+            stat = os.fstat(tokens_file.fileno())
+
+        tokens_json = json_lib.loads(content) if content else {}
+        _tokens_cache = ((stat.st_mtime, stat.st_size), tokens_json)
 
         return tokens_json
 
@@ -106,8 +151,7 @@ class GClient(object):
                 self._access_token = api_tokens_dict['access_token']
 
             if 'expiry_from_epoch' in api_tokens_dict:
-                expiry_from_epoch = api_tokens_dict['expiry_from_epoch']
-                self._expiry_from_epoch = datetime.datetime.fromtimestamp(expiry_from_epoch)
+                self._expiry_from_epoch = api_tokens_dict['expiry_from_epoch']
 
     def save_tokens_file(self):
         """ Saves the tokens file (optionally) with the necessary fields for
@@ -115,64 +159,92 @@ class GClient(object):
               track multiple tokens & expiry dates.
         """
 
-        tokens_json = self.load_tokens_file()
-        if self.NAME not in tokens_json:
-            tokens_json[self.NAME] = {}
+        global _tokens_cache
 
-        update_file = False
+        api_tokens_json = {}
 
         # prevent unnecessary future refreshes if access-token is not expired
         if self._access_token is not None:
-            tokens_json[self.NAME]['access_token'] = self._access_token
-            update_file = True
+            api_tokens_json['access_token'] = self._access_token
 
         if self._expiry_from_epoch is not None:
-            tokens_json[self.NAME]['expiry_from_epoch'] = int(self._expiry_from_epoch.strftime('%s'))
-            update_file = True
-
-        if update_file:
-            retries = 5
-            is_updated = False
-            while retries > 0:
-                try:
-                    with open(TOKENS_FILE, 'w') as tokens_file:
-                        json.dump(tokens_json, tokens_file)
-                    is_updated = True
-                    break
-                except IOError:
-                    time.sleep(5)
-                finally:
-                    retries -= 1
-
-            if not is_updated:
-                raise Exception('Tokens file (%s) could not be written. Max retries reached.' % TOKENS_FILE)
+            api_tokens_json['expiry_from_epoch'] = self._expiry_from_epoch
+
+        if not api_tokens_json:
+            return
+
+        # read-modify-write under one exclusive lock, so concurrent writers can't clobber each other
+        fd = os.open(TOKENS_FILE, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'rb+') as tokens_file:
+            fcntl.flock(tokens_file, fcntl.LOCK_EX)
+
+            content = tokens_file.read()
+            tokens_json = json_lib.loads(content) if content else {}
+            tokens_json.setdefault(self.NAME, {}).update(api_tokens_json)
+
+            tokens_file.seek(0)
+            tokens_file.truncate()
+            content = json_lib.dumps(tokens_json)
+            # orjson dumps bytes, the stdlib a string
+            tokens_file.write(content if isinstance(content, bytes) else content.encode('utf-8'))
+            tokens_file.flush()
+
+            stat = os.fstat(tokens_file.fileno())
+            _tokens_cache = ((stat.st_mtime, stat.st_size), tokens_json)
 
     def do_refresh_token(self):
         """ Return whether or not we should refresh our access token """
 
         return self._expiry_from_epoch is None or \
-                self._expiry_from_epoch <= datetime.datetime.now()
+                self._expiry_from_epoch <= time.time() + self.EXPIRY_BUFFER
+
+    def refresh_token(self, force=False):
+        """ Refresh our access-token because it has expired or we don't have one
 
-    def refresh_token(self):
-        """ Refresh our access-token because it has expired or we don't have one """
+        Args:
+          force: bool (optional) to refresh even if our access-token looks valid,
+                   e.g. when the API rejected it
+        """
 
-        payload = dict(client_id=self._client_id,
-                       client_secret=self._client_secret,
-                       refresh_token=self._refresh_token,
-                       grant_type='refresh_token')
+        if not force and self._access_token is not None and not self.do_refresh_token():
+            return
 
-        res = requests.post(self.REFRESH_TOKEN_URL,
-                            data=payload)
+        stale_access_token = self._access_token
 
-        if res.status_code != 200:
-            raise Exception('Access token could not be refreshed\n%s' % res.text)
+        # only one refresh per API at a time, concurrent callers wait on it and reuse its token
+        with self._get_refresh_lock():
+            # another thread or client may have refreshed while we waited
+            tokens_json = self.load_tokens_file()
+            if tokens_json:
+                self._load_json_tokens(tokens_json)
 
-        json_res = json.loads(res.text)
-        self._access_token = json_res['access_token']
-        self._expiry_from_epoch = datetime.datetime.now() + \
-                                    datetime.timedelta(seconds=json_res['expires_in'])
+            is_token_valid = self._access_token is not None and not self.do_refresh_token()
+            if is_token_valid and (not force or self._access_token != stale_access_token):
+                return
 
-        self.save_tokens_file()
+            payload = dict(client_id=self._client_id,
+                           client_secret=self._client_secret,
+                           refresh_token=self._refresh_token,
+                           grant_type='refresh_token')
+
+            res = self._session.post(self.REFRESH_TOKEN_URL,
+                                     data=payload)
+
+            if res.status_code != 200:
+                raise Exception('Access token could not be refreshed\n%s' % res.text)
+
+            json_res = json_lib.loads(res.content)
+            self._access_token = json_res['access_token']
+            self._expiry_from_epoch = int(time.time()) + json_res['expires_in']
+
+            self.save_tokens_file()
+
+    @classmethod
+    def _get_refresh_lock(cls):
+        """ Returns the lock guarding token refreshes for this Google API """
+
+        with GClient._refresh_locks_lock:
+            return GClient._refresh_locks.setdefault(cls.NAME, threading.Lock())
 
     @abstractmethod
     def poll(self, *args, **kwargs):
@@ -189,7 +261,7 @@ class GDriveClient(GClient):
         super(GDriveClient, self).__init__(*args, **kwargs)
         self._refresh_token = decrypt_token(settings['GDRIVE_REFRESH_TOKEN'])
 
-    def __build_request_headers(self, data=None):
+    def _build_request_headers(self, data=None):
         """ Builds the headers we'll include in a request to Google's API
 
         Args:
@@ -216,45 +288,37 @@ class GDriveClient(GClient):
         """
 
         if method_name not in {'get', 'post', 'put'}:
-            raise ValueError('Drive API does not support the %s HTTP method. ' +
-                             'Must be one of get, post, or put.' % method_name)
+            raise ValueError(('Drive API does not support the %s HTTP method. '
+                              'Must be one of get, post, or put.') % method_name)
+
+        # refresh up-front rather than waiting on a 401 round-trip
+        if self.do_refresh_token():
+            self.refresh_token()
 
         headers = {}
         if 'data' in kwargs:
             # cast to a string b/c the content-type is json
             kwargs['data'] = str(kwargs['data'])
-            headers = self.__build_request_headers(kwargs['data'])
+            headers = self._build_request_headers(kwargs['data'])
         else:
-            headers = self.__build_request_headers()
+            headers = self._build_request_headers()
 
         kwargs['headers'] = headers
 
-        api_call = functools.partial(getattr(requests, method_name), *args, **kwargs)
+        api_call = self._methods[method_name]
 
-        res = None
-        retries = 5
-        while retries > 0:
-            try:
-                res = api_call()
-                if res.status_code == 200:
-                    break
-                elif res.status_code == 401:
-                    self.refresh_token()
+        # transient errors are retried with backoff by the session's adapter,
+        #   only a rejected token is handled here
+        res = api_call(*args, **kwargs)
+        if res.status_code == 401: # e.g. clock skew, our expiry was off
+            self.refresh_token(force=True)
 
-                    # we have to rebuild the headers so they have the new token
-                    kwargs['headers'] = self.__build_request_headers(kwargs.get('data'))
-                    api_call = functools.partial(getattr(requests, method_name), *args, **kwargs)
-
-                    retries = 2 # only retry once more after we refresh the token
-            except Exception: # API may have blipped
-                time.sleep(5)
-            finally:
-                retries -= 1
+            # we have to rebuild the headers so they have the new token
+            kwargs['headers'] = self._build_request_headers(kwargs.get('data'))
 
-        if res is None:
-            raise Exception('Unable to get a response from the API')
+            res = api_call(*args, **kwargs) # only retry once more after we refresh the token
 
-        return res.json()
+        return json_lib.loads(res.content)
 
 
 class GSheetClient(GClient):
@@ -314,7 +378,7 @@ class GSheetClient(GClient):
             # 401, refresh the token, it didn't get refreshed in client() prob from a
             #   wrong expiry or we're close to the expiration date
             except gdata.client.Unauthorized:
-                self.refresh_token()
+                self.refresh_token(force=True)
             except Exception: # API may have blipped
                 time.sleep(5)
             finally:
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module makes gclient's Google Drive API calls asynchronously
+      on top of aiohttp, so many calls can be in flight at once.
+      Unlike gclient it needs Python 3.7+, and aiohttp is only
+      required by users of this module.
+"""
+
+from email.utils import parsedate_to_datetime
+from gclient import GDriveClient, json_lib
+
+import aiohttp
+import asyncio
+import datetime
+import random
+import time
+import weakref
+
+
+MAX_RETRY_WAIT = 300 # seconds, a server's Retry-After can't stall a call for longer
+
+
+def get_retry_wait(attempt, base, retry_after=None):
+    """ Returns how many seconds to wait before retrying a request,
+          preferring the server's Retry-After up to MAX_RETRY_WAIT
+
+    Args:
+      attempt: int of how many retries have been made so far
+      base: float of the exponential backoff's base, in seconds
+      retry_after: str (optional) of the response's Retry-After header,
+                     either in seconds or as an HTTP-date
+    """
+
+    if retry_after is not None:
+        try:
+            return min(max(0.0, float(retry_after)), MAX_RETRY_WAIT)
+        except ValueError:
+            pass
+
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            pass
+        else:
+            # HTTP-dates are in GMT, but a "-0000" offset parses as a naive datetime
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+            return min(max(0.0, retry_at.timestamp() - time.time()), MAX_RETRY_WAIT)
+
+    # jitter keeps concurrent calls from retrying in lock-step
+    return base * 2 ** attempt + random.uniform(0, base)
+
+
+class AsyncGDriveClient(GDriveClient):
+    """ Handles API calls to the Google Drive API without blocking the event loop,
+          so callers can await many of them together, e.g.
+          await asyncio.gather(*(client.poll_async('get', url) for url in urls))
+
+        Await close_async() before the event loop is closed.
+    """
+
+    # asyncio locks are bound to one event loop, keyed weakly so closed loops can be collected
+    _async_refresh_locks = weakref.WeakKeyDictionary()
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncGDriveClient, self).__init__(*args, **kwargs)
+        self._async_session = None # created lazily, aiohttp needs a running event loop
+
+    @classmethod
+    def _get_async_refresh_lock(cls):
+        """ Returns the asyncio lock guarding token refreshes on the running event loop """
+
+        locks = AsyncGDriveClient._async_refresh_locks
+
+        # a lock that has been waited on refers back to its loop, keeping the weak key alive
+        for closed_loop in [l for l in locks if l.is_closed()]:
+            del locks[closed_loop]
+
+        return locks.setdefault(asyncio.get_running_loop(), asyncio.Lock())
+
+    async def refresh_token_async(self, force=False):
+        """ Refresh our access-token like refresh_token, without blocking the event loop
+
+        Args:
+          force: bool (optional) to refresh even if our access-token looks valid,
+                   e.g. when the API rejected it
+        """
+
+        if not force and self._access_token is not None and not self.do_refresh_token():
+            return
+
+        stale_access_token = self._access_token
+
+        # coroutines queue up here, so only one of them ties up a thread on the refresh lock
+        async with self._get_async_refresh_lock():
+            if force and self._access_token != stale_access_token:
+                return # another coroutine refreshed while we waited
+
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.refresh_token, force)
+
+    def _get_async_session(self):
+        """ Returns the aiohttp session, creating it on first use """
+
+        if self._async_session is None or self._async_session.closed:
+            self._async_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=16))
+
+        return self._async_session
+
+    async def close_async(self):
+        """ Closes the aiohttp session, call it before the event loop is closed """
+
+        if self._async_session is not None:
+            await self._async_session.close()
+            self._async_session = None
+
+    async def _request_async(self, method_name, *args, **kwargs):
+        """ Sends a request through the aiohttp session. Connection errors and
+              RETRY's status codes are retried up to RETRY.total times, with
+              jittered exponential backoff or after the response's Retry-After.
+
+        Args:
+          method_name: string of the HTTP method to send
+          args: list (optional) of args for the request
+          kwargs: dict (optional) of keyword-args for the request
+
+        Returns:
+          tuple of the response's status code and body
+        """
+
+        session = self._get_async_session()
+
+        for attempt in range(self.RETRY.total + 1):
+            is_last_attempt = attempt == self.RETRY.total
+
+            try:
+                async with session.request(method_name.upper(), *args, **kwargs) as res:
+                    content = await res.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if is_last_attempt:
+                    raise
+                await asyncio.sleep(get_retry_wait(attempt, self.RETRY.backoff_factor))
+                continue
+
+            if res.status not in self.RETRY.status_forcelist or is_last_attempt:
+                return res.status, content
+
+            await asyncio.sleep(get_retry_wait(attempt, self.RETRY.backoff_factor,
+                                               res.headers.get('Retry-After')))
+
+    async def poll_async(self, method_name, *args, **kwargs):
+        """ Polls the GDrive API like poll, and always returns a dictionary
+              of values (from JSON).
+
+        Args:
+          method_name: string representing the HTTP method we want to send to the
+                         API (one of get, post, put)
+          args: list (optional) of args for the method to be called
+          kwargs: dict (optional) of keyword-args for the method to be called
+        """
+
+        if method_name not in {'get', 'post', 'put'}:
+            raise ValueError(('Drive API does not support the %s HTTP method. '
+                              'Must be one of get, post, or put.') % method_name)
+
+        # refresh up-front rather than waiting on a 401 round-trip
+        if self.do_refresh_token():
+            await self.refresh_token_async()
+
+        if 'data' in kwargs:
+            # cast to a string b/c the content-type is json
+            kwargs['data'] = str(kwargs['data'])
+
+        kwargs['headers'] = self._build_request_headers(kwargs.get('data'))
+
+        status, content = await self._request_async(method_name, *args, **kwargs)
+        if status == 401: # e.g. clock skew, our expiry was off
+            await self.refresh_token_async(force=True)
+
+            # we have to rebuild the headers so they have the new token
+            kwargs['headers'] = self._build_request_headers(kwargs.get('data'))
+
+            status, content = await self._request_async(method_name, *args, **kwargs)
+
+        return json_lib.loads(content)
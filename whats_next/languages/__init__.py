@@ -1,5 +1,4 @@
 __all__ = ["python", "todo"]
 
 # make languages available at the package level
-import python
-import todo
+from . import python, todo
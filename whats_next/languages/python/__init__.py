@@ -1,2 +1,4 @@
 FILE_EXTENSIONS = ("py",)
-TODO_GRAMMAR = r"^#\s*TODO\s+(.*)$"
+TODO_GRAMMAR = r"^#[ \t]*TODO[ \t]+(.*)$" # whole files are scanned, [ \t] keeps a match to one line
+TODO_LITERAL = b"TODO" # cheap substring every TODO_GRAMMAR match contains
+MAX_SCAN_BYTES = 10 * 1024 * 1024 # bigger files are generated, not worth scanning
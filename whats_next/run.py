@@ -1,15 +1,17 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from __future__ import print_function
-
-from collections import defaultdict, namedtuple
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 import argparse
+import itertools
 import languages
 import logging
+import mmap
 import os
 import re
+import sys
 
 
 LOGGING_FORMAT = "%(asctime)s %(levelname)s: %(message)s"
@@ -21,15 +23,18 @@ logger.setLevel(logging.INFO)
 
 class Task(object):
     """ Represents a TODO task """
+    __slots__ = ("text", "filename") # there can be tens of thousands of these
+
     def __init__(self, text, filename=None):
         self.text = text
-        self.filename = filename
+        # many tasks can share a file, keep one copy of its name
+        self.filename = sys.intern(filename) if filename is not None else None
 
     def __str__(self):
         if self.filename is not None:
-            fmted_txt = "[ ] {} ({})".format(self.text, self.filename)
+            fmted_txt = f"[ ] {self.text} ({self.filename})"
         else:
-            fmted_txt  = "[ ] {}".format(self.text)
+            fmted_txt = f"[ ] {self.text}"
 
         return fmted_txt
 
@@ -39,6 +44,9 @@ class LanguageScanner(object):
           "TODO definitions" and outputs them.
     """
     OUTPUT_FILE = "tasks_todo.out"
+    MAX_SERIAL_SCAN_FILES = 64 # any more files than this are scanned in parallel
+    BINARY_SNIFF_BYTES = 512 # leading bytes checked for a null byte to detect binary files
+    MMAP_MIN_BYTES = 1 << 20 # smaller files are read in one call, mapping them costs more
 
     def __init__(self, languages_to_scan, output_to_file=False):
         """ Initializes our language scanner.
@@ -52,7 +60,31 @@ class LanguageScanner(object):
         self._languages_to_scan = languages_to_scan
         self._output_to_file = output_to_file
 
-    def get_tasks_from_file(self, filename_path, filename, todo_grammar):
+    @staticmethod
+    def find_task_texts(content, todo_re, todo_literal=b""):
+        """ Find the text of every TODO task in a file's content.
+
+        :param content: Whole content of the file
+        :type content: bytes or mmap.mmap
+
+        :param todo_re: Compiled multi-line regex grammar to find a TODO task
+        :type todo_re: re.Pattern
+
+        :param todo_literal: Substring of every TODO task, content without it skips the regex
+        :type todo_literal: bytes
+
+        :returns: Non-empty texts of the TODO tasks
+        :rtype: list<str>
+        """
+        # far cheaper than the regex, and most files bail here
+        if content.find(todo_literal) == -1:
+            return []
+
+        task_texts = [match_obj.group(1).strip().decode("utf-8", "replace")
+                      for match_obj in todo_re.finditer(content)]
+        return [task_text for task_text in task_texts if task_text]
+
+    def get_tasks_from_file(self, filename_path, filename, todo_re, todo_literal=b""):
         """ Get all TODO tasks from the passed in file that match the provided regex grammar.
 
         :param filename_path: Absolutely path of the file
@@ -61,98 +93,179 @@ class LanguageScanner(object):
         :param filename: Name of the file, not including the path
         :type filename: str
 
-        :param todo_grammar: Regex grammar to find a TODO task
-        :type todo_grammar: str
+        :param todo_re: Compiled multi-line regex grammar to find a TODO task
+        :type todo_re: re.Pattern
+
+        :param todo_literal: Substring of every TODO task, files without it skip the regex
+        :type todo_literal: bytes
 
         :returns: Generator of Tasks with relevant fields
         :rtype: generator<Task>
         """
 
-        task_dict = defaultdict(list)
+        task_texts = []
 
         with open(filename_path, "rb") as in_file:
-            for line in in_file:
-                match_obj = re.match(todo_grammar, line)
-                if match_obj is not None:
-                    task_text = match_obj.group(1).strip()
-                    if task_text:
-                        task_dict[filename].append(task_text)
-
-        if len(task_dict) == 1: # all in one file
-            print("All tasks are defined inside {}".format(task_dict.keys()[0]))
-            for task_text in task_dict.values()[0]:
-                yield Task(task_text)
-        else:
-            for filename, task_texts in task_dict.values():
-                for task_text in task_texts:
-                    yield Task(filename, task_text)
-
+            file_size = os.fstat(in_file.fileno()).st_size
+            head = in_file.read(LanguageScanner.BINARY_SNIFF_BYTES)
+
+            # there's nothing to find in an empty file; a null byte up front means
+            #   the file is binary, e.g. a build artifact
+            if file_size and b"\0" not in head:
+                # scan the whole file in one go, instead of line by line in Python
+                if file_size < LanguageScanner.MMAP_MIN_BYTES:
+                    task_texts = self.find_task_texts(head + in_file.read(), todo_re, todo_literal)
+                else:
+                    with mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ) as in_map:
+                        task_texts = self.find_task_texts(in_map, todo_re, todo_literal)
+
+        # the file's name is printed as a header by the caller, the tasks don't repeat it
+        for task_text in task_texts:
+            yield Task(task_text)
+
+    def get_task_list_from_file(self, filename_path, filename, todo_re, todo_literal=b""):
+        """ Get all TODO tasks from the passed in file as a list, so they can be sent back
+              from a worker process. See get_tasks_from_file for the params.
+
+        :returns: Name of the file and a list of its Tasks
+        :rtype: tuple<str, list<Task>>
+        """
+        return filename, list(self.get_tasks_from_file(filename_path, filename, todo_re, todo_literal))
 
-    def scan_for_tasks(self, file_exts, todo_grammar, start_dir=None, level=1):
-        """ Scanning the current working directory for files that match the
-              extension criteria and return all the tasks found.
+    def find_files(self, file_exts, max_scan_bytes=None, start_dir=None, level=1, is_debug=None):
+        """ Recursively find the files under the directory that match the extension criteria.
 
         :param file_exts: File extensions that qualify files for scanning
         :type file_exts: tuple
 
-        :param todo_grammar: Regex with a match to the TODO initiative
-        :type todo_grammar: str
+        :param max_scan_bytes: Files bigger than this are skipped, e.g. minified or generated ones
+        :type max_scan_bytes: int
 
-        :param start_dir: Path of the directory to start scanning from
+        :param start_dir: Path of the directory to start looking from
         :type start_dir: str
 
         :param level: Level of depth we have traversed to
         :type level: int
 
-        :returns: Generator of TODO tasks ready to be reported on
-        :rtype: generator<Task>
+        :param is_debug: Log each entry, checked against the logger when not passed
+        :type is_debug: bool
+
+        :returns: Generator of the files' absolute paths and names
+        :rtype: generator<str, str>
         """
         if start_dir is None:
             start_dir = os.getcwd()
 
-        lpad_spaces = "  ".join("" for i in xrange(level))
+        # checked once at the top of the walk and passed down, debug calls are skipped when off
+        if is_debug is None:
+            is_debug = logger.isEnabledFor(logging.DEBUG)
 
-        dir_files = os.listdir(start_dir)
-        if dir_files:
-            max_filename_len = max(len(f) for f in dir_files)
+        # entries carry their file type from the directory listing, sparing a stat per check
+        with os.scandir(start_dir) as dir_entries:
+            dir_files = list(dir_entries)
 
-        for filename in dir_files:
-            filename_path = os.path.join(start_dir, filename)
+        # only needed to line up the debug lines
+        if is_debug:
+            lpad_spaces = "  " * (level - 1)
+            max_filename_len = max((len(f.name) for f in dir_files), default=0)
+
+        for dir_file in dir_files:
+            filename = dir_file.name
+            filename_path = dir_file.path
 
             # ignore sym-links
-            if os.path.islink(filename_path):
-                logger.debug(("{lpad_spaces}{:<{rpad_space_count}} - ignoring symlink"
-                             ).format(filename, lpad_spaces=lpad_spaces, rpad_space_count=max_filename_len))
+            if dir_file.is_symlink():
+                if is_debug:
+                    logger.debug("%s%-*s - ignoring symlink", lpad_spaces, max_filename_len, filename)
 
-            # recurse and scan this directory's files
-            elif os.path.isdir(filename_path):
-                logger.debug(("{lpad_spaces}{:<{rpad_space_count}} - scanning directory"
-                             ).format(filename, lpad_spaces=lpad_spaces, rpad_space_count=max_filename_len))
+            # recurse into this directory's files
+            elif dir_file.is_dir(follow_symlinks=False):
+                if is_debug:
+                    logger.debug("%s%-*s - scanning directory", lpad_spaces, max_filename_len, filename)
 
-                for t in self.scan_for_tasks(file_exts, todo_grammar, filename_path, level+1):
-                    yield t
+                for f in self.find_files(file_exts, max_scan_bytes, filename_path, level+1, is_debug):
+                    yield f
             # ignore mis-matchd file-extensions
-            elif os.path.splitext(filename)[1][1:] not in file_exts:
-                logger.debug(("{lpad_spaces}{:<{rpad_space_count}} - ignoring mismatched file-extension"
-                             ).format(filename, lpad_spaces=lpad_spaces, rpad_space_count=max_filename_len))
-
-            # scan this file
-            elif os.path.isfile(filename_path):
-                task_count = 0
-                for t in self.get_tasks_from_file(filename_path, filename, todo_grammar):
-                    task_count += 1
-                    yield t
+            elif filename.rpartition(".")[2] not in file_exts:
+                if is_debug:
+                    logger.debug("%s%-*s - ignoring mismatched file-extension", lpad_spaces, max_filename_len, filename)
+
+            # ignore FIFOs, sockets and devices, opening a FIFO would block forever
+            elif not dir_file.is_file(follow_symlinks=False):
+                if is_debug:
+                    logger.debug("%s%-*s - ignoring non-regular file", lpad_spaces, max_filename_len, filename)
+
+            # ignore files too big to be hand-written; unlike the type checks this is an lstat
+            #   syscall on POSIX, so it comes after the checks served from the directory listing
+            elif max_scan_bytes is not None and dir_file.stat(follow_symlinks=False).st_size > max_scan_bytes:
+                if is_debug:
+                    logger.debug("%s%-*s - ignoring file larger than %s bytes", lpad_spaces, max_filename_len, filename,
+                                 max_scan_bytes)
+
+            # this file will be scanned
+            else:
+                if is_debug:
+                    logger.debug("%s%-*s - queued for scanning", lpad_spaces, max_filename_len, filename)
 
-                logger.debug(("{lpad_spaces}{:<{rpad_space_count}} - {task_count} TODO "
-                              "tasks defined").format(filename, lpad_spaces=lpad_spaces,
-                                                      rpad_space_count=max_filename_len,
-                                                      task_count=task_count))
+                yield filename_path, filename
+
+    def scan_for_tasks(self, file_exts, todo_re, todo_literal=b"", max_scan_bytes=None, start_dir=None):
+        """ Scanning the current working directory for files that match the
+              extension criteria and return all the tasks found. Files are
+              independent, so they're scanned in parallel across processes.
+
+        :param file_exts: File extensions that qualify files for scanning
+        :type file_exts: tuple
+
+        :param todo_re: Compiled regex with a match to the TODO initiative
+        :type todo_re: re.Pattern
+
+        :param todo_literal: Substring of every TODO task, used to skip files before the regex
+        :type todo_literal: bytes
+
+        :param max_scan_bytes: Files bigger than this are skipped
+        :type max_scan_bytes: int
+
+        :param start_dir: Path of the directory to start scanning from
+        :type start_dir: str
+
+        :returns: Generator of TODO tasks ready to be reported on
+        :rtype: generator<Task>
+        """
+        files = sorted(self.find_files(file_exts, max_scan_bytes, start_dir)) # sorted to keep output deterministic
+        if not files:
+            return
+
+        filename_paths, filenames = zip(*files)
+        scan_args = (filename_paths, filenames, itertools.repeat(todo_re), itertools.repeat(todo_literal))
+
+        # spinning up processes isn't worth it for a handful of files
+        executor = None
+        if len(files) > LanguageScanner.MAX_SERIAL_SCAN_FILES:
+            executor = ProcessPoolExecutor()
+            task_lists = executor.map(self.get_task_list_from_file, *scan_args, chunksize=32)
+        else:
+            task_lists = map(self.get_task_list_from_file, *scan_args)
+
+        try:
+            # workers only return their results, all printing happens here and in file order
+            for filename_path, (filename, tasks) in zip(filename_paths, task_lists):
+                logger.debug("%s - %s TODO tasks defined", filename_path, len(tasks))
+                if not tasks:
+                    continue
+
+                print("All tasks are defined inside {}".format(filename))
+                for t in tasks:
+                    yield t
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
     def output(self, tasks):
-        """ Output the provided tasks to the configured output medium.
+        """ Output the provided tasks to the configured output medium, each as soon as it's found.
 
         :param tasks: Tasks to be outputted
-        :type tasks: list
+        :type tasks: iterable
         """
         if not self._output_to_file:
             do_std_out_print = True
@@ -166,9 +279,12 @@ class LanguageScanner(object):
         if do_std_out_print:
             logger.debug("Outputting tasks to stdout...")
 
-            if tasks:
-                for task in tasks:
-                    print(str(task))
+            task_count = 0
+            for task in tasks:
+                print(task)
+                task_count += 1
+
+            if task_count:
                 print()
             else:
                 logger.debug("No tasks found!")
@@ -176,9 +292,9 @@ class LanguageScanner(object):
             logger.debug("Done")
         else:
             logger.debug("Outputting tasks to %s...", LanguageScanner.OUTPUT_FILE)
-            with open(LanguageScanner.OUTPUT_FILE, "wb") as out_file:
+            with open(LanguageScanner.OUTPUT_FILE, "w") as out_file:
                 for task in tasks:
-                    out_file.write(str(task))
+                    print(task, file=out_file)
             logger.debug("Done")
 
     def run(self):
@@ -200,9 +316,16 @@ class LanguageScanner(object):
                 logger.info("Skipping language %s, missing TODO_GRAMMAR definition", lang_mod_name)
                 continue
 
+            # compiled once per language, rather than looked up per line; as a bytes pattern it
+            #   matches the binary file contents directly and skips Unicode matching, while
+            #   multi-line mode lets it run over whole files at once
+            todo_re = re.compile(todo_grammar.encode("utf-8"), re.MULTILINE)
+
+            todo_literal = getattr(lang_mod, "TODO_LITERAL", b"") # optional, empty never filters
+            max_scan_bytes = getattr(lang_mod, "MAX_SCAN_BYTES", None) # optional, no limit by default
+
             logger.debug("Scanning for tasks")
-            tasks = list(self.scan_for_tasks(file_exts, todo_grammar))
-            self.output(tasks)
+            self.output(self.scan_for_tasks(file_exts, todo_re, todo_literal, max_scan_bytes))
 
 
 def main():